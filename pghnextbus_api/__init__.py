@@ -4,7 +4,6 @@ from flask.ext.cors import CORS
 
 from functools import wraps
 
-from pghbustime import BustimeAPI
 import info
 
 app = Flask(__name__)
@@ -18,16 +17,49 @@ app.config.update(
     routes = info.routes,
     stops = info.stops,
     patterns = info.patterns,
+    stoproutes = info.stoproutes,
     
     # Port Authority API key
     apiKey = "API KEY GOES HERE",
+    apiBase = "http://realtime.portauthority.org/bustime/api/v1/",
     apiGood = True,
     
     # General options
     maxStops = 125,
     minSearch = 3,
-    maxNearest = 12
+    maxNearest = 12,
+    maxBoard = 25,
+    
+    # Baseline cache lifetimes (seconds), see expiry.py
+    stopTTL = 20,
+    busTTL = 15,
+    
+    # Dead reckoning between vehicle reports, see reckon.py. Moving buses
+    # are refreshed every `reckonTTL` seconds instead of `busTTL`.
+    reckon = True,
+    reckonTTL = 45,
+    reckonHorizon = 90,
+    
+    # Upstream resilience, see upstream.py. Last good responses are kept for
+    # `staleTTL` seconds to serve while Port Authority is failing.
+    staleTTL = 600,
+    hedgeUpstream = False,
+    upstreamTimeout = 5,
+    
+    # Fill caches in the background when a worker starts, see warmup.py
+    warmup = True,
+    
+    # Sampling profiler, see profiler.py. Requests slower than
+    # `profileThreshold` seconds are kept automatically (0 disables), and
+    # are only sampled once they've run for `profileAfter` of it.
+    profileInterval = 0.01,
+    profileThreshold = 1.0,
+    profileAfter = 0.25,
+    profileKeep = 20
 )
+
+# Port Authority client with request timeouts, needs the config above
+from .upstream import BustimeAPI
 app.config.update(
     api = BustimeAPI(app.config.get('apiKey')),
     cur_routes = [ (rt, app.config['routes'][rt]['name']) for rt in sorted(app.config['routes'].keys())]
@@ -49,5 +81,7 @@ def require_appkey(view_function):
             abort(401)
     return decorated_function
     
+from . import profiler
+from . import warmup
 from . import views
 
@@ -1,39 +1,38 @@
-from . import utils
+from . import utils, cacheutil, ingest, reckon, upstream
 from . import app
-from pghbustime import Stop, Route, BustimeAPI, BustimeError, Bus
+from pghbustime import Route, BustimeError, Bus
 from pghbustime.interface import APILimitExceeded
 
 import json
 import geojson
+import md5
+import time
 from flask import Response
 
-## /api/stop
+## /api/stopdb
 
-def singlestop(sid, config, multipart=False):
-    """Return JSON for a single stop `sid`."""
+def stopschecksum(config):
+    """Checksum of the stop database, computed once per process."""
+    if not config.get('stopsChecksum'):
+        config['stopsChecksum'] = md5.md5(repr(config['stops'])).hexdigest()
+    return config['stopsChecksum']
     
-    # Create a new stop object to get at the prediction.
-    stopObject = Stop.get(config['api'], sid)
+def stopdb(config):
+    """JSON for the full stop database."""
+    return json.dumps({'checksum': stopschecksum(config), 'stops': config['stops']})
     
-    # Get predictions.
-    try:
-        stopPredictions = list(stopObject.predictions())
-    except BustimeError as e:
-        if type(e) is APILimitExceeded:
-            app.config['disabled_api'] = True
-            
-        stopPredictions = False
+## /api/stop
+
+def stopresponse(sid, predictions, config, multipart=False):
+    """Build the response structure for stop `sid` from formatted predictions.
+    `predictions` is None when they couldn't be fetched."""
     
-    # Create formatted tuples with prediction info for display.
-    if stopPredictions:
-        predictions = [utils.formatPrediction(p, usejson=True) for p in stopPredictions]
-    else:
-        predictions = [] 
-         
     resp = {
-        'predictions': predictions,
-        'vids': "-".join([p['vid'] for p in predictions])
+        'predictions': predictions or [],
+        'vids': "-".join([p['vid'] for p in predictions or []])
         }
+    if predictions is None:
+        resp['unavailable'] = True
         
     if not multipart:
         resp['stopInfo'] = {
@@ -42,21 +41,57 @@ def singlestop(sid, config, multipart=False):
         }
 
     return resp
+
+def singlestop(sid, config, multipart=False):
+    """Return JSON for a single stop `sid`."""
     
-def multistop(sid, config):
-    """Generate a JSON response for multiple routes."""
+    predictions = fetchpredictions([sid], config)[sid]
+    return stopresponse(sid, predictions, config, multipart)
+    
+def joinstops(responses):
+    """Merge single stop responses into one, soonest prediction first."""
     
-    stops = sid.replace("multi:", "").split(",")    
-    responses = [singlestop(sid, config, multipart=True) for sid in stops]
     predictions = reduce(list.__add__, (r['predictions'] for r in responses) )
     predictions = sorted(predictions, key=lambda p: p['eta'])
     joined = {
         'predictions': predictions,
         'vids': "-".join([p['vid'] for p in predictions])
     }
+    if any(r.get('unavailable') for r in responses):
+        joined['unavailable'] = True
     
     return joined
     
+def multistop(sid, config):
+    """Generate a JSON response for multiple routes."""
+    
+    stops = sid.replace("multi:", "").split(",")    
+    fetched = fetchpredictions(stops, config)
+    responses = [stopresponse(sid, fetched[sid], config, multipart=True) for sid in stops]
+    return joinstops(responses)
+    
+def overlimit(sid, config):
+    """Placeholder response for `sid` while the API is disabled."""
+    
+    resp = {
+        'predictions': [
+            {"dist":0.0,
+            "destination":"API OVER LIMIT",
+            "display":"soon",
+            "eta":"",
+            "vid":0000,
+            "route":"API Error",
+            "direction":"We've exceeded our daily allotment for Port Authority data requests."}
+        ],
+        'vids': "9999"
+    }
+    resp['stopInfo'] = {
+        'name': config['stops'][sid][-1],
+        'loc': config['stops'][sid][1]
+    }
+    
+    return resp
+    
 def stop(sid, config):
     if not config.get('disabled_api'):
         if "multi:" in sid:
@@ -64,25 +99,115 @@ def stop(sid, config):
         else:
             resp = singlestop(sid, config)
     else:
-        resp = {
-            'predictions': [
-                {"dist":0.0,
-                "destination":"API OVER LIMIT",
-                "display":"soon",
-                "eta":"",
-                "vid":0000,
-                "route":"API Error",
-                "direction":"We've exceeded our daily allotment for Port Authority data requests."}
-            ],
-            'vids': "9999"
-        }
-        resp['stopInfo'] = {
-            'name': config['stops'][sid][-1],
-            'loc': config['stops'][sid][1]
-        }
+        resp = overlimit(sid, config)
+    
+    resp['fetched'] = int(time.time())
+    return cacheutil.dumps(resp)    
+
+def stalestop(stale):
+    """Stop response from the kept copy `stale`, with ETAs counted down by
+    its age and buses that should have arrived dropped."""
+    resp = json.loads(stale)
+    age = int(round((time.time() - resp['fetched']) / 60.0))
+
+    predictions = []
+    for p in resp['predictions']:
+        eta = p['eta'] - age
+        if eta >= 0:
+            p.update(eta=eta, display=utils.displayclass(eta))
+            predictions.append(p)
+    resp.update(predictions=predictions, vids="-".join(p['vid'] for p in predictions), stale=True)
+
+    return cacheutil.dumps(resp)
         
-    return json.dumps(resp)    
+## /api/board
+
+def groupsize(config):
+    """Most member stops in any grouped stop, computed once per process."""
+    if not config.get('maxGroup'):
+        config['maxGroup'] = max(len(sid.split(",")) for sid in config['stops'])
+    return config['maxGroup']
+    
+def boardstops(raw, config):
+    """Split a comma separated `raw` list of stop ids into at most `maxBoard`
+    known ids. Grouped `multi:` ids contain commas themselves, so they take
+    the longest run of following ids that forms a known group."""
+    
+    stops, size = config['stops'], groupsize(config)
+    # Never look at more ids than `maxBoard` groups could hold
+    limit = config['maxBoard'] * size
+    tokens = [t.strip() for t in raw.split(",", limit)[:limit] if t.strip()]
+    sids, unknown = [], []
+    i = 0
+    while i < len(tokens) and len(sids) < config['maxBoard']:
+        sid, end = tokens[i], i + 1
+        if "multi:" in sid:
+            for j in range(min(len(tokens), i + size), i, -1):
+                candidate = ",".join(tokens[i:j])
+                if candidate in stops:
+                    sid, end = candidate, j
+                    break
         
+        if sid in stops:
+            if sid not in sids: sids.append(sid)
+        else:
+            unknown.append(sid)
+        i = end
+    
+    return sids, unknown
+    
+def fetchpredictions(stopids, config):
+    """Fetch formatted predictions for every stop in `stopids`, packing as many
+    stops into each upstream request as the Port Authority API allows. The
+    responses are parsed by `ingest` rather than through `pghbustime`. If a
+    batch fails as a whole its stops are retried one by one, so one stop's
+    error can't empty the others. Stops that couldn't be fetched map to None,
+    stops without service to an empty list."""
+    MAX_STOPS = 10
+    
+    stopids = list(stopids)
+    resp = {}
+    for i in range(0, len(stopids), MAX_STOPS):
+        chunk = stopids[i:i+MAX_STOPS]
+        try:
+            fetched = upstream.call('predictions', ingest.predictions, chunk, config)
+            default = []
+        except BustimeError as e:
+            fetched, default = {}, None
+            if type(e) is APILimitExceeded:
+                app.config['disabled_api'] = True
+            elif len(chunk) > 1 and type(e) not in (upstream.UpstreamUnavailable, upstream.UpstreamError):
+                for sid in chunk:
+                    fetched.update(fetchpredictions([sid], config))
+        
+        for sid in chunk:
+            resp[sid] = fetched.get(sid, default)
+    
+    return resp
+
+def board(sids, config):
+    """Return a dict of stop id to the structure `stop` would produce for
+    every stop in `sids`, fetching all of their member stops in one batch."""
+    
+    if config.get('disabled_api'):
+        resp = {sid: overlimit(sid, config) for sid in sids}
+        for r in resp.values():
+            r['fetched'] = int(time.time())
+        return resp
+    
+    members = {sid: sid.replace("multi:", "").split(",") for sid in sids}
+    fetched = fetchpredictions(set(m for ms in members.values() for m in ms), config)
+    
+    resp = {}
+    for sid in sids:
+        if "multi:" in sid:
+            responses = [stopresponse(m, fetched[m], config, multipart=True) for m in members[sid]]
+            resp[sid] = joinstops(responses)
+        else:
+            resp[sid] = stopresponse(sid, fetched[sid], config)
+        resp[sid]['fetched'] = int(time.time())
+    
+    return resp
     
 ## /api/near
     
@@ -98,6 +223,38 @@ def nearby(lat, lng, config, maxNearest=10):
     
     return resp
     
+## /api/routesnear
+
+def routesnear(lat, lng, config, maxNearest=10):
+    """List the routes serving the `maxNearest` stops closest to `(lat, lng)`,
+    with the nearest stop in each direction. Answered entirely from the
+    in-memory stop database and `stoproutes` index. `maxNearest` is clamped
+    to `1..config['maxNearest']`."""
+    try:
+        loc = map(float, (lat, lng))
+        maxNearest = min(max(int(maxNearest), 1), config['maxNearest'])
+    except ValueError:
+        return json.dumps({'error': 'Invalid lat/lng pair or stop count.'})
+    
+    routes = {}
+    for miToStop, stop in utils.nearest(config['stops'].values(), loc, maxNearest):
+        for rt, name, direction in config['stoproutes'].get(stop[0], []):
+            route = routes.setdefault(rt, {
+                'route': rt,
+                'name': name,
+                'miToStop': round(miToStop, 3)
+            })
+            # Stops arrive sorted by distance, so keep the first per direction
+            if direction not in route:
+                route[direction] = {
+                    'stopId': stop[0],
+                    'name': stop[2],
+                    'miToStop': round(miToStop, 3)
+                }
+    
+    resp = sorted(routes.values(), key=lambda r: (r['miToStop'], r['route']))
+    return json.dumps({'routes': resp})
+    
 ## /api/find    
     
 def find(q):
@@ -107,26 +264,43 @@ def find(q):
     
 ## /api/onroute    
     
+def getroute(api, rt):
+    """Route `rt`. pghbustime fetches the route list once and then answers
+    from `Route.all_routes`, so only that first fetch goes through the
+    breaker and counts towards its latency."""
+    if not Route.all_routes:
+        return upstream.call('routes', Route.get, api, rt)
+    return Route.get(api, rt)
+
 def busseson(rt, config):
     """Return GeoJSON or error to get all busses on route `rt`."""
     
     rt = rt.split(',')
     valid = all(r in config['routes'] for r in rt)
     if valid:
-        busobjs, offroute = [], []
+        busobjs, offroute, unavailable = [], [], []
         for r in rt:
             try: 
-                buslist = list(Route.get(config['api'], r).busses)
+                route = getroute(config['api'], r)
+                buslist = upstream.call('vehicles', lambda: list(route.busses))
                 busobjs.append(buslist)
+            except (upstream.UpstreamUnavailable, upstream.UpstreamError):
+                unavailable.append(r)
             except:
                 offroute.append(r)
                 
         if busobjs:        
             busobjs = reduce(list.__add__, busobjs)            
             onroute = utils.geojsonOnRoute(busobjs)
+            if config['reckon']:
+                onroute['features'] = [reckon.project(f, config['patterns'], config['reckonHorizon']) for f in onroute['features']]
             onroute['inactive'] = offroute
+            onroute['unavailable'] = unavailable
             resp = geojson.dumps(onroute)
             resp = Response(resp, mimetype='text/json')
+        elif unavailable:
+            resp = json.dumps({'error': 'Bus locations are temporarily unavailable.'})
+            resp = Response(resp, mimetype='text/json', status=503)
         else:
             resp = json.dumps({'error': 'This route has no busses.'})        
             resp = Response(resp, mimetype='text/json', status=404)
@@ -154,14 +328,24 @@ def bus(vid, api):
 
     try:
         # Get geoJSON from the API response.
-        busobj = Bus.get(api, vid)
-        resp = utils.geojsonBus(busobj)
+        busobj = upstream.call('vehicles', Bus.get, api, vid)
+        resp = utils.geojsonBus(busobj) or notfound
     except BustimeError as e:
         # Return a "bus not found" geoJSON response.
         if type(e) is APILimitExceeded:
             app.config['disabled_api'] = True        
+        elif type(e) in (upstream.UpstreamUnavailable, upstream.UpstreamError):
+            notfound['properties']['unavailable'] = True
         resp = notfound
-    return geojson.dumps(resp)
+    
+    resp['properties']['fetched'] = int(time.time())
+    return cacheutil.dumps(resp)
+
+def stalebus(stale):
+    """Bus response from the kept copy `stale`, flagged as stale."""
+    resp = json.loads(stale)
+    resp['properties']['stale'] = True
+    return cacheutil.dumps(resp)
 
 def nextstops(preds, api):
     if preds.get('predictions'):
@@ -169,7 +353,7 @@ def nextstops(preds, api):
         nexts = {}
         for vid in vids:
             try:
-                nexts[vid] = Bus.get(api, vid).next_stop.stop.name
+                nexts[vid] = upstream.call('vehicles', lambda: Bus.get(api, vid).next_stop.stop.name)
             except BustimeError as e:
                 if type(e) is APILimitExceeded:
                     app.config['disabled_api'] = True                                
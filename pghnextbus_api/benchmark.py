@@ -0,0 +1,143 @@
+"""Microbenchmarks for the hot paths of the API. Run from this directory:
+
+    python benchmark.py ingest [-n PREDICTIONS]
+    python benchmark.py cache [-n BUSSES]
+
+The cache round trips go to the memcached in `MEMCACHIER_SERVERS`, or a
+local one on 127.0.0.1:11211.
+"""
+
+import argparse
+import os
+import random
+import timeit
+import zlib
+import cPickle as pickle
+from datetime import datetime, timedelta
+from StringIO import StringIO
+
+import geojson
+import xmltodict
+from pytz import timezone
+from pghbustime import BustimeAPI, Prediction
+from pghbustime.datatypes import OfflineBus
+
+import cacheutil
+import ingest
+import utils
+
+# Routes along Forbes Ave and where their outbound trips end
+ROUTES = [('61A', 'Swissvale'), ('61B', 'Braddock'), ('61C', 'McKeesport'),
+          ('61D', 'Waterfront'), ('67', 'Monroeville'), ('69', 'Trafford')]
+
+def predictionsxml(n):
+    """A synthetic `getpredictions` response with `n` predictions."""
+    now = datetime.now(timezone("US/Eastern"))
+    prds = []
+    for i in range(n):
+        prdtm = now + timedelta(minutes=random.randint(0, 60))
+        rt, des = random.choice(ROUTES)
+        rtdir = random.choice(['INBOUND', 'OUTBOUND'])
+        prds.append("""<prd><tmstmp>{ts}</tmstmp><typ>A</typ><stpnm>Forbes Ave at Morewood</stpnm>
+<stpid>{stpid}</stpid><vid>{vid}</vid><dstp>{dstp}</dstp><rt>{rt}</rt><rtdir>{rtdir}</rtdir>
+<des>{des}</des><prdtm>{prdtm}</prdtm><tablockid>{rt}-123</tablockid><tatripid>456</tatripid>
+<zone></zone></prd>""".format(
+            ts=now.strftime("%Y%m%d %H:%M:%S"), stpid=7117 + i % 10, vid=5000 + i,
+            dstp=random.randint(100, 50000), rt=rt, rtdir=rtdir,
+            des='Downtown' if rtdir == 'INBOUND' else des, prdtm=prdtm.strftime("%Y%m%d %H:%M:%S")))
+
+    return "<?xml version=\"1.0\"?><bustime-response>{}</bustime-response>".format("".join(prds))
+
+def bench_ingest(n, repeat=20):
+    xml = predictionsxml(n)
+    api = BustimeAPI("benchmark")
+
+    def format(p):
+        # Attach the vehicle so `p.bus.vid` doesn't call the API
+        prediction = Prediction.fromapi(api, p)
+        prediction._busobj = OfflineBus(p['vid'])
+        return utils.formatPrediction(prediction, usejson=True)
+
+    def before():
+        prds = xmltodict.parse(xml)['bustime-response']['prd']
+        return [format(p) for p in prds]
+
+    def after():
+        return ingest.parsepredictions(StringIO(xml))
+
+    for name, fn in (('pghbustime objects', before), ('ingest', after)):
+        best = min(timeit.repeat(fn, number=1, repeat=repeat))
+        print "{:<20} {:>8.1f} us/prediction".format(name, best / n * 1e6)
+
+def busfeature(vid):
+    """A feature shaped like `utils.geojsonBus` output."""
+    return geojson.Feature(
+        geometry = geojson.Point((-79.94 - random.random() / 100, 40.44 + random.random() / 100)),
+        properties = {
+            'vid': str(vid),
+            'speed': random.randint(0, 40),
+            'heading': random.randint(0, 359),
+            'pattern': '3942',
+            'destination': 'Downtown',
+            'route': '61C',
+            'lastupdated': '2014-10-12 14:32:00-04:00',
+            'u_lastupdated': '1413138720',
+            'next_stop': 'Forbes Ave at Morewood',
+            'marker-size': 'medium',
+            'marker-symbol': 'bus',
+            'marker-color': '#f90'}
+    )
+
+def bench_cache(n, repeat=20):
+    from info import CACHE
+    features = [busfeature(5000 + i) for i in range(n)]
+
+    # Memory per key: pickled Feature (the old value) against compact JSON,
+    # compressed the way pylibmc would above the threshold.
+    def stored(text):
+        return len(zlib.compress(text)) if len(text) > cacheutil.COMPRESS_OVER else len(text)
+
+    pickled = sum(len(pickle.dumps(f, pickle.HIGHEST_PROTOCOL)) for f in features) / float(n)
+    compact = sum(stored(cacheutil.dumps(f)) for f in features) / float(n)
+    print "{:<20} {:>8.0f} bytes/key".format('pickled Feature', pickled)
+    print "{:<20} {:>8.0f} bytes/key".format('compact JSON', compact)
+
+    # A stop with 10 varied (synthetic) predictions, as /api/stop caches it
+    predictions = ingest.parsepredictions(StringIO(predictionsxml(10))).values()
+    stop = cacheutil.dumps({'predictions': sum(predictions, []), 'vids': '', 'fetched': 1413138720,
+        'stopInfo': {'name': 'Forbes Ave at Morewood', 'loc': ['40.444', '-79.943']}})
+    print "{:<20} {:>8} -> {} bytes".format('10 predictions', len(stop), stored(stop))
+
+    # Round trips: one get per bus against one get_multi for the route.
+    vids = [f['properties']['vid'] for f in features]
+    servers = os.environ.get('MEMCACHIER_SERVERS') or '127.0.0.1:11211'
+    try:
+        cacheutil.set_many(utils.ONROUTE_PREFIX, dict((f['properties']['vid'], cacheutil.dumps(f)) for f in features), time=60)
+    except Exception as e:
+        print "memcache at {} unavailable ({}), not timing round trips".format(servers, e)
+        print "{:<20} {:>8} round trips".format('get per bus', n)
+        print "{:<20} {:>8} round trips".format('get_multi', 1)
+        return
+
+    print "memcache at {}".format(servers)
+
+    def single():
+        return [CACHE.get(utils.ONROUTE_PREFIX + vid) for vid in vids]
+
+    def multi():
+        return cacheutil.get_many(utils.ONROUTE_PREFIX, vids)
+
+    for name, fn, trips in (('get per bus', single, n), ('get_multi', multi, 1)):
+        best = min(timeit.repeat(fn, number=1, repeat=repeat))
+        print "{:<20} {:>8} round trips {:>8.2f} ms".format(name, trips, best * 1e3)
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description="Microbenchmarks for the API hot paths.")
+    p.add_argument('bench', choices=['ingest', 'cache'])
+    p.add_argument('-n', type=int, default=200, help='Items per run.')
+
+    args = p.parse_args()
+    if args.bench == 'ingest':
+        bench_ingest(args.n)
+    elif args.bench == 'cache':
+        bench_cache(args.n)
@@ -0,0 +1,26 @@
+"""Batched, compact access to the per-item cache families (`_onroute_bus2_`,
+`_stop_`, `_vehicle_`). Values are stored as compact JSON text instead of
+pickled objects, and pylibmc zlib-compresses anything over `COMPRESS_OVER`
+bytes."""
+
+import json
+from info import CACHE
+
+COMPRESS_OVER = 512
+
+def dumps(value):
+    """Compact JSON encoding for a cache value."""
+    return json.dumps(value, separators=(',', ':'))
+
+def set(key, value, time=0):
+    """Store JSON text `value` under `key`."""
+    return CACHE.set(key, value, time=time, min_compress_len=COMPRESS_OVER)
+
+def get_many(prefix, ids):
+    """Fetch `prefix + id` for every id in `ids` in one round trip. Returns a
+    dict of id to JSON text for the hits only."""
+    return CACHE.get_multi([str(i) for i in ids], key_prefix=prefix)
+
+def set_many(prefix, values, time=0):
+    """Store a dict of id to JSON text under `prefix + id` in one round trip."""
+    return CACHE.set_multi(values, time=time, key_prefix=prefix, min_compress_len=COMPRESS_OVER)
@@ -0,0 +1,114 @@
+"""Cache lifetimes derived from the content being cached rather than a flat
+number of seconds. Responses carry the time they were fetched, and every
+cache hit on an entry older than the fixed lifetime is counted as an
+upstream call the policy saved."""
+
+import json
+import time
+from datetime import datetime
+from pytz import timezone
+
+# Port Authority runs (almost) nothing between these hours.
+QUIET_HOURS = (2, 5)
+
+# Stop lifetimes are rounded down to one of these so /api/board can store a
+# whole board in a few set_multi calls.
+STOP_BUCKETS = (40, 60, 120)
+
+# Per-family counters for /api/expirystats.
+STATS = {
+    'stop': {'sets': 0, 'seconds': 0, 'hits': 0, 'saved': 0},
+    'bus': {'sets': 0, 'seconds': 0, 'hits': 0, 'saved': 0}
+}
+
+def inservice(now=None):
+    """Whether `now` (Eastern) falls within regular service hours."""
+    now = now or datetime.now(timezone("US/Eastern"))
+    return not (QUIET_HOURS[0] <= now.hour < QUIET_HOURS[1])
+
+def record(family, ttl):
+    """Count a lifetime of `ttl` set for `family`."""
+    stats = STATS[family]
+    stats['sets'] += 1
+    stats['seconds'] += ttl
+    return ttl
+
+def served(family, fetched, config):
+    """Count a cache hit for `family` on an entry fetched at `fetched`. Past
+    the fixed lifetime the entry would have expired, so the hit saved an
+    upstream call."""
+    stats = STATS[family]
+    stats['hits'] += 1
+    if fetched and time.time() - fetched >= config['{}TTL'.format(family)]:
+        stats['saved'] += 1
+
+def stop(resp, config):
+    """Lifetime for a `/api/stop` response, based on the soonest ETA. A bus
+    40 minutes out will not move much in the next couple of minutes."""
+    fixed = config['stopTTL']
+    resp = json.loads(resp)
+    predictions = resp.get('predictions', [])
+    # The over limit placeholder has an empty ETA
+    etas = [p['eta'] for p in predictions if type(p['eta']) is int and p['eta'] >= 0]
+
+    if resp.get('unavailable'):
+        # The fetch failed, don't hold on to the failure any longer than usual
+        return record('stop', fixed)
+    elif not predictions:
+        # No service scheduled
+        ttl = 60
+    elif not etas:
+        ttl = fixed
+    else:
+        soonest = min(etas)
+        ttl = fixed + max(soonest - 5, 0) * 3
+        ttl = max([fixed] + [b for b in STOP_BUCKETS if b <= ttl])
+
+    if not inservice():
+        ttl = min(ttl * 2, 300)
+
+    return record('stop', ttl)
+
+def bus(resp, config):
+    """Lifetime for a `/api/bus` response, based on vehicle speed and how long
+    ago the vehicle last reported."""
+    fixed = config['busTTL']
+    properties = json.loads(resp).get('properties', {})
+
+    if properties.get('unavailable'):
+        # The fetch failed, don't hold on to the failure any longer than usual
+        return record('bus', fixed)
+    elif 'vid' not in properties:
+        # Location unavailable, don't keep asking
+        ttl = 30
+    else:
+        age = time.time() - int(properties.get('u_lastupdated') or 0)
+        speed = int(properties.get('speed') or 0)
+        if age > 300:
+            # Stale report, probably laid over or out of service
+            ttl = 60
+        elif speed == 0:
+            ttl = 30
+        elif config.get('reckon'):
+            # Positions are projected forward between fetches
+            ttl = config['reckonTTL']
+        else:
+            ttl = fixed
+
+    if not inservice():
+        ttl = min(ttl * 2, 120)
+
+    return record('bus', ttl)
+
+def stats(config):
+    """Summarize the policy against the fixed lifetimes."""
+    resp = {}
+    for family, s in STATS.items():
+        resp[family] = {
+            'fixedTTL': config['{}TTL'.format(family)],
+            'sets': s['sets'],
+            'meanTTL': round(float(s['seconds']) / s['sets'], 1) if s['sets'] else None,
+            'hits': s['hits'],
+            'upstreamCallsSaved': s['saved']
+        }
+    return resp
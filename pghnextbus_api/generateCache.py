@@ -103,6 +103,36 @@ def all_stops(api):
     
     return nchanges
     
+def stop_routes(dbname, stops):
+    """Create an SqliteDict mapping every stop id, including grouped `multi:`
+    ids from `stops`, to the (route, name, direction) tuples that serve it."""
+    
+    log = logging.getLogger(__name__)
+    
+    allroutes = SqliteDict(dbname, tablename="routes")
+    stoproutes = SqliteDict(dbname, tablename="stoproutes")
+    served = {}
+    
+    log.debug("Inverting route database.")
+    for rt, rtdict in allroutes.iteritems():
+        for direction in ('inbound', 'outbound'):
+            for sid in rtdict[direction]:
+                served.setdefault(sid, set()).add((rt, rtdict['name'], direction))
+    
+    # Grouped stops are served by everything that serves one of their members
+    for sid in stops:
+        if "multi:" in sid:
+            members = sid.replace("multi:", "").split(",")
+            served[sid] = set().union(*(served.get(m, set()) for m in members))
+    
+    for sid, rts in served.iteritems():
+        stoproutes[sid] = sorted(rts)
+    
+    log.debug("Committing changes...")
+    stoproutes.commit()
+    
+    return len(served)
+    
 def patterns(api, dbname):
     Route.get(api, 88)
     patterns = SqliteDict(dbname,  tablename="patterns")
@@ -198,6 +228,8 @@ if __name__ == '__main__':
     # all_routes(api, "./paac.db")
     # all_stops(api)
     patterns(api, "./paac.db")
+    with open("paac.stops.pickle") as f:
+        stop_routes("./paac.db", pickle.load(f))
     
     
         
@@ -16,6 +16,8 @@ routes = SqliteDict(DB_NAME, tablename='routes')
 #stops = SqliteDict(DB_NAME, tablename='stops')
 with open(PICKLE_NAME) as f: stops = pickle.load(f)
 patterns = SqliteDict(DB_NAME, tablename='patterns')
+# Inverted stop -> routes index, small enough to keep in memory
+stoproutes = dict(SqliteDict(DB_NAME, tablename='stoproutes').iteritems())
 
 # memcache
 def getmemcache():    
@@ -0,0 +1,82 @@
+"""Lean ingestion of upstream predictions. The XML is parsed incrementally
+and each `<prd>` element is turned straight into the dict `formatPrediction`
+would produce, without building `pghbustime` objects on the way."""
+
+import requests
+from datetime import datetime
+from pytz import timezone
+from xml.etree import cElementTree as ElementTree
+
+from pghbustime import BustimeError
+from pghbustime.interface import APILimitExceeded
+
+from utils import displayclass
+
+EASTERN = timezone("US/Eastern")
+FT_PER_MILE = 5280.0
+
+def timestamp(s):
+    """Parse a BusTime `YYYYMMDD HH:MM[:SS]` timestamp without strptime."""
+    return datetime(int(s[0:4]), int(s[4:6]), int(s[6:8]), int(s[9:11]), int(s[12:14]),
+                    int(s[15:17]) if len(s) > 15 else 0)
+
+def prediction(prd, now):
+    """Format a flat `prd` dict of tag -> text relative to naive Eastern `now`."""
+    eta = int(round((timestamp(prd['prdtm']) - now).total_seconds() / 60.0, 0))
+
+    return {
+        'route': prd['rt'],
+        'destination': prd['des'],
+        'direction': prd['rtdir'].capitalize(),
+        'eta': eta,
+        'dist': round(int(prd['dstp']) / FT_PER_MILE, 1),
+        'vid': prd['vid'],
+        'display': displayclass(eta)
+    }
+
+def parsepredictions(source, now=None):
+    """Parse a `getpredictions` response from file-like `source` into a dict
+    of stop id to formatted predictions. Stops the API reports an error for
+    (e.g. no service scheduled) map to an empty list, and malformed `<prd>`
+    records are skipped."""
+    # One clock read per batch; BusTime timestamps are naive Eastern.
+    now = now or datetime.now(EASTERN).replace(tzinfo=None)
+    resp = {}
+    elem = None
+
+    for event, elem in ElementTree.iterparse(source):
+        if elem.tag == 'prd':
+            prd = dict((child.tag, child.text) for child in elem)
+            elem.clear()
+            try:
+                resp.setdefault(prd['stpid'], []).append(prediction(prd, now))
+            except Exception:
+                # Skip a malformed record rather than lose the whole batch
+                continue
+        elif elem.tag == 'error':
+            msg = elem.findtext('msg') or ''
+            stpid = elem.findtext('stpid')
+            if stpid:
+                resp.setdefault(stpid, [])
+            elif 'transaction limit' in msg.lower() or 'exceeded' in msg.lower():
+                raise APILimitExceeded(msg)
+            else:
+                raise BustimeError(msg)
+            elem.clear()
+
+    # The root closes last; anything else is an error page, not an answer
+    if elem is None or elem.tag != 'bustime-response':
+        raise ValueError("Not a bustime-response document.")
+    return resp
+
+def predictions(stopids, config):
+    """Fetch and parse predictions for up to ten `stopids` in one request.
+    HTTP and parse errors are left to `upstream.call`, which records them
+    against the breaker and raises them as `UpstreamError`."""
+    url = "{}getpredictions".format(config['apiBase'])
+    params = {'key': config['apiKey'], 'stpid': ",".join(stopids), 'tmres': 's'}
+
+    r = requests.get(url, params=params, stream=True, timeout=config['upstreamTimeout'])
+    r.raise_for_status()
+    r.raw.decode_content = True
+    return parsepredictions(r.raw)
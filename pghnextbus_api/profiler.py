@@ -0,0 +1,194 @@
+"""On-demand sampling profiler for requests. A single background thread
+walks the stacks of in-flight requests every `profileInterval` seconds.
+Requests that ask for a profile (`?profile=1` with a valid `key`) are
+sampled from the start and always kept. Every other request is tracked,
+but only sampled once it has run for `profileAfter` of `profileThreshold`,
+so stack walks cost nothing on fast requests; it is kept if it ends up
+slower than `profileThreshold` seconds. Upstream and
+cache calls made inside `span()`, and every memcache call, show up as
+pseudo-frames under the endpoint that made them."""
+
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from xml.sax.saxutils import escape
+
+from flask import request
+
+from . import app
+import info
+
+PROFILES = deque(maxlen=app.config['profileKeep'])
+
+# Thread ident -> Profile for every request in flight
+_ACTIVE = {}
+_IDS = itertools.count(1)
+_SAMPLER = {}
+_LOCK = threading.Lock()
+
+class Profile(object):
+    """Samples and upstream/cache calls for one request."""
+
+    def __init__(self, endpoint, path, forced):
+        self.id = next(_IDS)
+        self.endpoint = endpoint
+        self.path = path
+        self.forced = forced
+        self.started = time.time()
+        self.duration = None
+        self.samples = Counter()
+        self.spans = []
+        self.calls = []
+
+    def collapsed(self):
+        """Samples in collapsed stack format, one `frame;frame;... count` per line."""
+        return "\n".join("{};{} {}".format(self.endpoint, stack, n) for stack, n in self.samples.most_common())
+
+    def summary(self):
+        return {
+            'id': self.id,
+            'endpoint': self.endpoint,
+            'path': self.path,
+            'forced': self.forced,
+            'started': self.started,
+            'duration': self.duration and round(self.duration, 4),
+            'samples': sum(self.samples.values()),
+            'calls': [{'call': tag, 'seconds': round(s, 4)} for tag, s in self.calls]
+        }
+
+def collapse(frame, spans):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append("{} ({})".format(code.co_name, os.path.basename(code.co_filename)))
+        frame = frame.f_back
+    stack.reverse()
+    stack.extend("[{}]".format(tag) for tag in spans)
+    return ";".join(stack)
+
+def sample(config=app.config, active=_ACTIVE, sleep=time.sleep, clock=time.time,
+           current_frames=sys._current_frames):
+    """Sampler loop, only walks stacks of forced requests and requests that
+    are on their way to being slow. Holds its own references so module
+    teardown at exit doesn't break it."""
+    while True:
+        sleep(config['profileInterval'])
+        started = clock() - config['profileThreshold'] * config['profileAfter']
+        due = [(ident, profile) for ident, profile in active.items()
+               if profile.forced or profile.started <= started]
+        if not due:
+            continue
+        frames = current_frames()
+        for ident, profile in due:
+            frame = frames.get(ident)
+            if frame is not None:
+                profile.samples[collapse(frame, list(profile.spans))] += 1
+
+def current():
+    return _ACTIVE.get(threading.current_thread().ident)
+
+@contextmanager
+def span(tag):
+    """Label upstream or cache work done by the current request."""
+    profile = current()
+    if profile is None:
+        yield
+        return
+
+    profile.spans.append(tag)
+    start = time.time()
+    try:
+        yield
+    finally:
+        profile.calls.append((tag, time.time() - start))
+        profile.spans.pop()
+
+def traced(tag, fn):
+    """Wrap `fn` so calls made during a profiled request are labelled `tag`."""
+    def call(*args, **kwargs):
+        if current() is None:
+            return fn(*args, **kwargs)
+        with span(tag):
+            return fn(*args, **kwargs)
+    return call
+
+for method in ('get', 'set', 'get_multi', 'set_multi'):
+    setattr(info.CACHE, method, traced("cache:{}".format(method), getattr(info.CACHE, method)))
+
+@app.before_request
+def begin():
+    key = request.args.get('key')
+    asked = request.args.get('profile', '').lower() in ('1', 'true', 'yes')
+    forced = asked and key is not None and key == app.config['localAPIKey']
+    if not (forced or app.config['profileThreshold']):
+        return
+
+    with _LOCK:
+        if not _SAMPLER:
+            t = threading.Thread(target=sample, name="profiler")
+            t.daemon = True
+            t.start()
+            _SAMPLER['thread'] = t
+
+    _ACTIVE[threading.current_thread().ident] = Profile(request.endpoint or request.path, request.path, forced)
+
+@app.after_request
+def finish(response):
+    profile = _ACTIVE.pop(threading.current_thread().ident, None)
+    if profile is not None:
+        profile.duration = time.time() - profile.started
+        threshold = app.config['profileThreshold']
+        if profile.forced or (threshold and profile.duration >= threshold):
+            PROFILES.append(profile)
+            response.headers['X-Profile-Id'] = str(profile.id)
+    return response
+
+@app.teardown_request
+def discard(exc=None):
+    _ACTIVE.pop(threading.current_thread().ident, None)
+
+def get(pid):
+    for profile in PROFILES:
+        if profile.id == pid:
+            return profile
+
+def flamegraph(profile, width=1200, row=16):
+    """Render `profile` as a standalone SVG flame graph."""
+    # Build a tree of frame -> (count, children)
+    root = [0, {}]
+    for stack, n in profile.samples.items():
+        node = root
+        node[0] += n
+        for frame in [profile.endpoint] + stack.split(";"):
+            node = node[1].setdefault(frame, [0, {}])
+            node[0] += n
+
+    def depth(node):
+        return 1 + max([depth(c) for c in node[1].values()] or [0])
+
+    total = float(root[0] or 1)
+    height = (depth(root) - 1) * row
+    rects = []
+
+    def layout(node, x, level):
+        for name, child in sorted(node[1].items()):
+            w = child[0] / total * width
+            y = height - (level + 1) * row
+            hue = 30 if name.startswith("[") else 10 + hash(name) % 40
+            label = escape(name[:int(w / 7)]) if w > 40 else ""
+            rects.append(
+                '<g><title>{title} ({n} samples)</title>'
+                '<rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="{h}" fill="hsl({hue},80%,60%)" stroke="#fff"/>'
+                '<text x="{tx:.1f}" y="{ty}" font-size="11" font-family="monospace">{label}</text></g>'.format(
+                    title=escape(name), n=child[0], x=x, y=y, w=w, h=row - 1, hue=hue,
+                    tx=x + 3, ty=y + row - 4, label=label))
+            layout(child, x, level + 1)
+            x += w
+
+    layout(root, 0.0, 0)
+    return ('<svg xmlns="http://www.w3.org/2000/svg" width="{}" height="{}">{}</svg>'
+            .format(width, height, "".join(rects)))
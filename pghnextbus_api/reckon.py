@@ -0,0 +1,82 @@
+"""Dead reckoning for vehicles between real position reports: snap the last
+reported position onto the vehicle's pattern and move it forward along the
+line at its reported speed."""
+
+import bisect
+import math
+import time
+import geojson
+
+from . import utils
+
+# Pattern id -> (coordinates, cumulative miles at each coordinate)
+_LINES = {}
+
+def line(pid, patterns):
+    """Return the `(coords, cumulative)` polyline for pattern `pid`, measuring it
+    the first time it is used."""
+    if pid not in _LINES:
+        coords = [tuple(map(float, c)) for c in patterns[pid]['coordinates']]
+        cumulative = [0.0]
+        for a, b in zip(coords, coords[1:]):
+            cumulative.append(cumulative[-1] + utils.haversine(a[::-1], b[::-1]))
+        _LINES[pid] = (coords, cumulative)
+
+    return _LINES[pid]
+
+def snap(point, coords, cumulative):
+    """Distance in miles along the polyline to the closest point to `point`.
+    Segments are short enough to treat as flat once longitude is scaled."""
+    kx = math.cos(math.radians(point[1]))
+    px, py = point[0] * kx, point[1]
+    best = None
+
+    for i in range(len(coords) - 1):
+        ax, ay = coords[i][0] * kx, coords[i][1]
+        dx, dy = coords[i+1][0] * kx - ax, coords[i+1][1] - ay
+        seg = dx*dx + dy*dy
+        t = max(0.0, min(1.0, ((px - ax)*dx + (py - ay)*dy) / seg)) if seg else 0.0
+        d = (ax + t*dx - px)**2 + (ay + t*dy - py)**2
+        if best is None or d < best[0]:
+            best = (d, i, t)
+
+    d, i, t = best
+    return cumulative[i] + t * (cumulative[i+1] - cumulative[i])
+
+def along(distance, coords, cumulative):
+    """The `(lng, lat)` point `distance` miles along the polyline."""
+    i = bisect.bisect_right(cumulative, distance) - 1
+    i = max(0, min(i, len(coords) - 2))
+    seg = cumulative[i+1] - cumulative[i]
+    t = min(1.0, (distance - cumulative[i]) / seg) if seg else 0.0
+    a, b = coords[i], coords[i+1]
+
+    return (a[0] + t*(b[0] - a[0]), a[1] + t*(b[1] - a[1]))
+
+def project(feature, patterns, horizon=90, now=None):
+    """Return bus `feature` moved forward along its pattern for the time since
+    its last update, capped at `horizon` seconds. Features that can't be
+    projected are returned unchanged."""
+    now = now or time.time()
+    properties = feature.get('properties', {})
+    pid = str(properties.get('pattern'))
+
+    try:
+        speed = float(properties.get('speed') or 0)
+        elapsed = now - int(properties['u_lastupdated'])
+    except (KeyError, ValueError):
+        return feature
+
+    elapsed = min(elapsed, horizon)
+    if speed <= 0 or elapsed <= 0 or pid not in patterns:
+        return feature
+
+    coords, cumulative = line(pid, patterns)
+    if len(coords) < 2:
+        return feature
+
+    start = snap(feature['geometry']['coordinates'], coords, cumulative)
+    position = along(start + speed * elapsed / 3600.0, coords, cumulative)
+
+    properties = dict(properties, estimated=True, u_estimated=str(int(now)))
+    return geojson.Feature(geometry=geojson.Point(position), properties=properties)
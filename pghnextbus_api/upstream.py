@@ -0,0 +1,179 @@
+"""Health tracking for calls to the Port Authority API. Each call type gets
+a circuit breaker over a rolling window of recent calls: while the upstream
+is failing or slow, calls fail fast with `UpstreamUnavailable` (a
+`BustimeError`, so handlers fall back to their degraded responses) until a
+single probe call gets through again. Timeouts, HTTP errors and responses
+that aren't API answers are raised as `UpstreamError` and count against
+the breaker; API answers like "no service" or "over the limit" don't."""
+
+import threading
+import time
+import Queue
+import requests
+from collections import deque
+
+import pghbustime
+from pghbustime import BustimeError
+from . import app, profiler
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+class UpstreamUnavailable(BustimeError):
+    """Raised instead of calling upstream while a breaker is open."""
+    pass
+
+class UpstreamError(BustimeError):
+    """The upstream call timed out, failed or didn't return an API response."""
+    pass
+
+class BustimeAPI(pghbustime.BustimeAPI):
+    """`pghbustime` client whose requests time out after `upstreamTimeout`
+    seconds and whose transport failures raise `UpstreamError`."""
+
+    def response(self, url):
+        try:
+            r = requests.get(url, timeout=app.config['upstreamTimeout'])
+            r.raise_for_status()
+        except requests.RequestException as e:
+            raise UpstreamError("Port Authority request failed: {}".format(e))
+
+        # pghbustime reports an HTML error page as a plain BustimeError
+        if self.RESPONSE_TOKEN not in r.content:
+            raise UpstreamError("The Bustime API returned an invalid response.")
+        return self.parseresponse(r.content)
+
+class Breaker(object):
+    """Rolling latency/error window and breaker state for one call type."""
+
+    def __init__(self, name, window=50, minCalls=10, errorRate=0.5, slowCall=5.0, cooldown=30):
+        self.name = name
+        self.calls = deque(maxlen=window)
+        self.minCalls = minCalls
+        self.errorRate = errorRate
+        self.slowCall = slowCall
+        self.cooldown = cooldown
+
+        self.state = CLOSED
+        self.openedAt = None
+        self.trips = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may go upstream now. Once the cooldown has passed an
+        open breaker lets one probe through per cooldown."""
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            elif time.time() - self.openedAt >= self.cooldown:
+                self.state = HALF_OPEN
+                self.openedAt = time.time()
+                return True
+            else:
+                return False
+
+    def record(self, latency, ok):
+        """Record a finished call. Slow calls count as failures."""
+        ok = ok and latency < self.slowCall
+        with self.lock:
+            self.calls.append((latency, ok))
+            if self.state == HALF_OPEN:
+                if ok:
+                    self.state = CLOSED
+                    self.calls.clear()
+                else:
+                    self.trip()
+            elif self.state == CLOSED and len(self.calls) >= self.minCalls:
+                if self.errors() >= self.errorRate:
+                    self.trip()
+
+    def trip(self):
+        self.state = OPEN
+        self.openedAt = time.time()
+        self.trips += 1
+
+    def errors(self):
+        """Fraction of failed calls in the window."""
+        if not self.calls:
+            return 0.0
+        return sum(1 for latency, ok in self.calls if not ok) / float(len(self.calls))
+
+    def percentile(self, pct):
+        """Latency percentile of successful calls in the window, or None."""
+        latencies = sorted(latency for latency, ok in self.calls if ok)
+        if len(latencies) < self.minCalls:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * pct))]
+
+    def status(self):
+        return {
+            'state': self.state,
+            'calls': len(self.calls),
+            'errorRate': round(self.errors(), 3),
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'trips': self.trips,
+            'openedAt': self.openedAt
+        }
+
+BREAKERS = {kind: Breaker(kind) for kind in ('predictions', 'vehicles', 'routes')}
+
+def hedged(fn, after):
+    """Call `fn`, starting a second identical call if the first hasn't
+    finished after `after` seconds, and return whichever finishes first."""
+    results = Queue.Queue()
+
+    def run():
+        try:
+            results.put((True, fn()))
+        except Exception as e:
+            results.put((False, e))
+
+    def start():
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+
+    start()
+    try:
+        ok, value = results.get(timeout=after)
+    except Queue.Empty:
+        start()
+        ok, value = results.get()
+
+    if ok:
+        return value
+    else:
+        raise value
+
+def call(kind, fn, *args, **kwargs):
+    """Call `fn(*args, **kwargs)` against the upstream API through the `kind`
+    breaker. Other `BustimeError`s are answers from a healthy API (no
+    predictions, over the limit) and don't count against it. Any other
+    failure is recorded and re-raised as `UpstreamError`."""
+    breaker = BREAKERS[kind]
+    if not breaker.allow():
+        raise UpstreamUnavailable("Port Authority {} data temporarily unavailable.".format(kind))
+
+    p95 = breaker.percentile(0.95)
+    start = time.time()
+    try:
+        with profiler.span("upstream:{}".format(kind)):
+            if app.config.get('hedgeUpstream') and p95 and breaker.state == CLOSED:
+                result = hedged(lambda: fn(*args, **kwargs), p95)
+            else:
+                result = fn(*args, **kwargs)
+    except UpstreamError:
+        breaker.record(time.time() - start, False)
+        raise
+    except BustimeError:
+        breaker.record(time.time() - start, True)
+        raise
+    except Exception as e:
+        breaker.record(time.time() - start, False)
+        raise UpstreamError("Port Authority {} call failed: {!r}".format(kind, e))
+
+    breaker.record(time.time() - start, True)
+    return result
+
+def status():
+    return {kind: breaker.status() for kind, breaker in BREAKERS.items()}
@@ -1,3 +1,5 @@
+import calendar
+import json
 import math
 import re
 import geojson
@@ -53,11 +55,20 @@ def standardize_stop_name(name):
 
     return name.strip()
 
+_INDEX = {}
+
+def stopindex():
+    """Open the Whoosh stop index once per process."""
+    from info import IDX_NAME
+    
+    if 'ix' not in _INDEX:
+        _INDEX['ix'] = open_dir(IDX_NAME)
+    return _INDEX['ix']
+
 def search(query):
     """Search the stopindex for `query` using Whoosh."""
-    from info import IDX_NAME
     
-    ix = open_dir(IDX_NAME)
+    ix = stopindex()
     parser = QueryParser("name", ix.schema)
     q = parser.parse(query)
 
@@ -89,6 +100,12 @@ def haversine(origin, destination, km=False):
     else:
         return d * KM_MILE
     
+def nearest(stops, coord, n):
+    """Return `(miToStop, stop)` pairs for the `n` stops closest to `coord`."""
+    
+    distances = ((haversine(map(float, s[1]), coord), s) for s in stops)
+    return sorted(distances, key=lambda d: d[0])[0:n]
+    
 def geojsonGrouped(stops, coord, n):
     """Group stops together by tokens in the name. For example, the stops
     `X St at Y Ave` and `X St opp Y Ave` would be treated as separate in the
@@ -97,14 +114,12 @@ def geojsonGrouped(stops, coord, n):
     def delta_sq(a, b): return (a[0] - b[0])**2 + (a[1] - b[1])**2
     
     # 3. Sort by distance and get the `n` closest.
-    raw_features = sorted(stops, key=lambda s: haversine(map(float, s[1]), coord))[0:n]
     grouped_features = []
     
-    for stop in raw_features:
+    for miToStop, stop in nearest(stops, coord, n):
         sid = stop[0]
         lat, lng = map(float, stop[1])
         name = stop[2]
-        miToStop = haversine(map(float, stop[1]), coord)
         miToStop = round(miToStop, 3)
                 
         grouped_features.append(geojson.Feature(
@@ -158,6 +173,18 @@ def geojsonFind(results):
     resp = geojson.FeatureCollection(grouped_features)        
     return geojson.dumps(resp)
     
+def nextstop(bus):
+    """Name of the next stop for `bus`, or "" if Port Authority can't say."""
+    from upstream import call
+    
+    try:
+        prd = call('predictions', bus.api.predictions, vid=bus.vid, maxpredictions=1)['prd']
+        if type(prd) is list:
+            prd = prd[0]
+        return prd['stpnm']
+    except (BustimeError, LookupError, TypeError):
+        return ""
+
 def geojsonBus(bus):
     """Create GeoJSON for a bus object."""
     
@@ -177,8 +204,8 @@ def geojsonBus(bus):
                     'destination': bus.destination,
                     'route': str(bus.route),
                     'lastupdated': str(bus.timeupdated),
-                    'u_lastupdated': bus.timeupdated.strftime("%s"),
-                    'next_stop': bus.next_stop.stop.name,
+                    'u_lastupdated': str(calendar.timegm(bus.timeupdated.utctimetuple())),
+                    'next_stop': nextstop(bus),
                     'marker-size': 'medium',
                     'marker-symbol': 'bus',
                     'marker-color': markercolor}
@@ -186,26 +213,45 @@ def geojsonBus(bus):
     except:
         pass    
 
+# Bumped when the cached feature encoding changes, so values written by an
+# older release are never read back (they used to be pickled Features)
+ONROUTE_PREFIX = "_onroute_bus2_"
+
 def geojsonOnRoute(buslist):
-    """Return a FeatureCollection of all busses in `buslist`."""
-    from info import CACHE
+    """Return a FeatureCollection of all busses in `buslist`, fetching cached
+    features for all of them in one round trip."""
+    from cacheutil import get_many, set_many, dumps
     
-    busses = []
+    buslist = [bus for bus in buslist if bus]
+    cached = get_many(ONROUTE_PREFIX, [bus.vid for bus in buslist])
+    
+    busses, fresh = [], {}
     for bus in buslist:
-        if bus:
-            ckey = "_onroute_bus_{}".format(bus.vid)            
-            cached = CACHE.get(ckey)
-            if not cached:
-                feature = geojsonBus(bus)
-                if feature:
-                    CACHE.set(ckey, feature, time=25)
-            else:    
-                feature = cached
+        vid = str(bus.vid)
+        if vid in cached:
+            feature = json.loads(cached[vid])
+        else:
+            feature = geojsonBus(bus)
+            # Don't keep a feature whose next stop couldn't be fetched
+            if feature and feature['properties']['next_stop']:
+                fresh[vid] = dumps(feature)
                 
-            if feature: busses.append(feature)
+        if feature: busses.append(feature)
+    
+    if fresh:
+        set_many(ONROUTE_PREFIX, fresh, time=25)
     return geojson.FeatureCollection(busses)    
     
 
+def displayclass(eta):
+    """CSS class for a prediction `eta` minutes away."""
+    if 0 <= eta <= 10:
+        return 'soon'
+    elif 10 < eta <= 25:
+        return 'kinda-soon'
+    else:
+        return 'later'
+
 def formatPrediction(p, usejson=False):
     """Turn a prediction object into a useful tuple for display."""
     FT_PER_MILE = 5280.0
@@ -218,12 +264,7 @@ def formatPrediction(p, usejson=False):
     dist = round(p.dist_to_stop / FT_PER_MILE, 1)
     
     if usejson:
-        if 0 <= eta <= 10:
-            displayClass = 'soon'
-        elif 10 < eta <= 25:
-            displayClass = 'kinda-soon'     
-        else:
-            displayClass = 'later'    
+        displayClass = displayclass(eta)
             
         direction = p.direction.capitalize()
         if p.is_arrival:
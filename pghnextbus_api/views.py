@@ -1,10 +1,9 @@
 from flask import Response, render_template, request, redirect, url_for
 
-from . import app, apihelper, require_appkey
+from . import app, apihelper, cacheutil, expiry, profiler, reckon, upstream, warmup, require_appkey
 import info
 import json
 import geojson
-import md5
 
 ##################### INTERFACE PAGES #########################
 
@@ -28,8 +27,7 @@ def apiavailableroutes():
 def apistopschecksum():
     ckey = '_stops_checksum'
     if not info.CACHE.get(ckey):
-        checksum = md5.md5(repr(app.config['stops'])).hexdigest()
-        resp = json.dumps({'checksum': checksum})
+        resp = json.dumps({'checksum': apihelper.stopschecksum(app.config)})
         info.CACHE.set(ckey, resp)
     
     resp = info.CACHE.get(ckey)    
@@ -40,8 +38,7 @@ def apistopschecksum():
 def apiappstops():
     ckey = "_stops"
     if not info.CACHE.get(ckey):
-        checksum = md5.md5(repr(app.config['stops'])).hexdigest()
-        resp = json.dumps({'checksum': checksum, 'stops': app.config['stops']})
+        resp = apihelper.stopdb(app.config)
         info.CACHE.set(ckey, resp)
         
     resp = info.CACHE.get(ckey)    
@@ -52,11 +49,61 @@ def apiappstops():
 def apistop(sid):
     """Get predictions for stop `sid` in JSON form."""    
     ckey = "_stop_{sid}".format(sid=sid)
-    if not info.CACHE.get(ckey):
-        resp = apihelper.stop(sid, app.config)
-        info.CACHE.set(ckey, resp, time=20)
+    stalekey = "_stale{}".format(ckey)
+    resp = info.CACHE.get(ckey)
+    if resp:
+        expiry.served('stop', json.loads(resp).get('fetched'), app.config)
+        return Response(resp, mimetype='text/json')
+    
+    resp = apihelper.stop(sid, app.config)
+    if json.loads(resp).get('unavailable'):
+        # Serve the last good response, counted down to now, and leave the
+        # failure uncached so the next request tries upstream again
+        stale = info.CACHE.get(stalekey)
+        if stale:
+            return Response(apihelper.stalestop(stale), mimetype='text/json')
+    elif not app.config.get('disabled_api'):
+        cacheutil.set(stalekey, resp, time=app.config['staleTTL'])
+    
+    cacheutil.set(ckey, resp, time=expiry.stop(resp, app.config))
+    return Response(resp, mimetype='text/json')
+    
+@app.route('/api/board')
+@require_appkey
+def apiboard():
+    """Get predictions for every stop in `?stops=a,b,multi:c,d` at once. Each
+    stop shares its cache entry with `/api/stop/<sid>`."""
+    sids, unknown = apihelper.boardstops(request.args.get('stops', ''), app.config)
+    
+    cached = cacheutil.get_many("_stop_", sids)
+    for resp in cached.values():
+        expiry.served('stop', json.loads(resp).get('fetched'), app.config)
+    missing = [sid for sid in sids if not cached.get(sid)]
+    if missing:
+        fresh = apihelper.board(missing, app.config)
+        failed = [sid for sid, r in fresh.items() if r.get('unavailable')]
+        fresh = {sid: cacheutil.dumps(r) for sid, r in fresh.items()}
+        
+        # Stops that failed fall back to their stale copies, like /api/stop
+        stale = cacheutil.get_many("_stale_stop_", failed) if failed else {}
+        good = {sid: r for sid, r in fresh.items() if sid not in failed}
+        if good and not app.config.get('disabled_api'):
+            cacheutil.set_many("_stale_stop_", good, time=app.config['staleTTL'])
+        
+        # One set_multi per lifetime bucket
+        lifetimes = {}
+        for sid, resp in fresh.items():
+            if sid not in stale:
+                lifetimes.setdefault(expiry.stop(resp, app.config), {})[sid] = resp
+        for ttl, values in lifetimes.items():
+            cacheutil.set_many("_stop_", values, time=ttl)
+        
+        fresh.update((sid, apihelper.stalestop(r)) for sid, r in stale.items())
+        cached.update(fresh)
     
-    resp = info.CACHE.get(ckey)        
+    # Cached values are already JSON, so splice them in rather than re-encode
+    stops = ", ".join("{}: {}".format(json.dumps(sid), cached[sid]) for sid in sids)
+    resp = '{{"stops": {{{}}}, "unknown": {}}}'.format(stops, json.dumps(unknown))
     return Response(resp, mimetype='text/json')
     
 @app.route('/api/near/<lat>/<lng>')
@@ -72,6 +119,19 @@ def apinearby(lat, lng):
     resp = info.CACHE.get(ckey)    
     return Response(resp, mimetype='text/json')    
 
+@app.route('/api/routesnear/<lat>/<lng>')
+@require_appkey
+def apiroutesnear(lat, lng):
+    """Get the routes serving stops near `(lat, lng)` in JSON form."""
+    maxNearest = request.args.get('n') or 10
+    ckey = "_routesnear_{}".format(hash((lat, lng, maxNearest)))
+    if not info.CACHE.get(ckey):
+        resp = apihelper.routesnear(lat, lng, app.config, maxNearest)
+        info.CACHE.set(ckey, resp)
+        
+    resp = info.CACHE.get(ckey)    
+    return Response(resp, mimetype='text/json')    
+
 @app.route('/api/find/<q>')    
 def apifind(q):
     """Return GeoJSON of search results for query `q`."""
@@ -94,13 +154,27 @@ def apiallbusses(rt):
 def apibuslocation(vid):
     """GeoJSON endpoint to get data on vehicle `vid`."""    
     ckey = "_vehicle_{}".format(vid)
+    stalekey = "_stale{}".format(ckey)
     
     if not app.config.get('disabled_api'):
-        if not info.CACHE.get(ckey):
-            resp = apihelper.bus(vid, app.config['api'])
-            info.CACHE.set(ckey, resp, time=15)
-
         resp = info.CACHE.get(ckey)
+        if resp:
+            expiry.served('bus', json.loads(resp)['properties'].get('fetched'), app.config)
+        else:
+            resp = apihelper.bus(vid, app.config['api'])
+            properties = json.loads(resp)['properties']
+            # Fall back to the last good position while Port Authority is
+            # failing, leaving the failure uncached
+            stale = info.CACHE.get(stalekey) if properties.get('unavailable') else None
+            if stale:
+                resp = apihelper.stalebus(stale)
+            else:
+                cacheutil.set(ckey, resp, time=expiry.bus(resp, app.config))
+                if 'vid' in properties:
+                    cacheutil.set(stalekey, resp, time=app.config['staleTTL'])
+        if app.config['reckon']:
+            resp = reckon.project(json.loads(resp), app.config['patterns'], app.config['reckonHorizon'])
+            resp = geojson.dumps(resp)
     else:
         resp = json.dumps({'error': 'API over limit.'})
         
@@ -139,4 +213,52 @@ def disablemessage():
 def apidisabled():
     resp = {'disabled': app.config.get('disabled_api') or False}
     return Response(json.dumps(resp), mimetype='text/json')
-    
\ No newline at end of file
+
+@app.route('/api/ready')
+def apiready():
+    """Readiness check for the load balancer, 503 until warm-up succeeds."""
+    if app.config['warmup']:
+        warmup.retry()
+    resp = warmup.status()
+    if not app.config['warmup']:
+        resp['ready'] = True
+    return Response(json.dumps(resp), mimetype='text/json', status=200 if resp['ready'] else 503)
+
+@app.route('/api/upstream')
+@require_appkey
+def apiupstream():
+    """Circuit breaker state and latency for each upstream call type."""
+    resp = upstream.status()
+    return Response(json.dumps(resp), mimetype='text/json')
+
+@app.route('/api/expirystats')
+@require_appkey
+def apiexpirystats():
+    """Upstream calls saved by adaptive cache lifetimes in this process."""
+    resp = expiry.stats(app.config)
+    return Response(json.dumps(resp), mimetype='text/json')
+
+#### Profiling #######
+@app.route('/api/profiles')
+@require_appkey
+def apiprofiles():
+    """Summaries of the kept request profiles, newest first."""
+    resp = {'profiles': [p.summary() for p in reversed(profiler.PROFILES)]}
+    return Response(json.dumps(resp), mimetype='text/json')
+
+@app.route('/api/profiles/<int:pid>/<fmt>')
+@require_appkey
+def apiprofile(pid, fmt):
+    """Download profile `pid` as collapsed stacks or a flame graph."""
+    profile = profiler.get(pid)
+    if not profile:
+        resp = json.dumps({'error': 'Profile not found.'})
+        return Response(resp, mimetype='text/json', status=404)
+    
+    if fmt == 'collapsed':
+        return Response(profile.collapsed(), mimetype='text/plain')
+    elif fmt == 'flamegraph':
+        return Response(profiler.flamegraph(profile), mimetype='image/svg+xml')
+    else:
+        resp = json.dumps({'error': 'Format must be collapsed or flamegraph.'})
+        return Response(resp, mimetype='text/json', status=404)
@@ -0,0 +1,93 @@
+"""Warm a worker when it starts serving: fill the static cache entries and
+build the in-memory search and pattern structures in the background, so
+the first live requests don't pay for them. Warm-up starts on a worker's
+first request rather than at import, so it runs in each forked worker
+(e.g. under `gunicorn --preload`) and not just the master. `/api/ready`
+reports ready once it has succeeded, and retries a failed warm-up.
+
+Nearest-stop lookups aren't warmed: they scan the stop table, which is
+loaded at import, and their results depend on the coordinate asked for."""
+
+import json
+import logging
+import threading
+import time
+import geojson
+
+from . import app, apihelper, cacheutil, reckon, utils
+import info
+
+STATE = {'ready': False, 'started': None, 'finished': None, 'error': None}
+_LOCK = threading.Lock()
+
+# Seconds to wait before retrying a failed warm-up
+RETRY_AFTER = 30
+
+def warm():
+    """Populate everything the static endpoints and lookups need."""
+    log = logging.getLogger(__name__)
+    config = app.config
+
+    log.debug("Warming stop database.")
+    static = {
+        '_available_routes': lambda: json.dumps({'available': config['cur_routes']}),
+        '_stops_checksum': lambda: json.dumps({'checksum': apihelper.stopschecksum(config)}),
+        '_stops': lambda: apihelper.stopdb(config)
+    }
+
+    # Only build what another worker hasn't already filled in
+    cached = info.CACHE.get_multi(static.keys())
+    info.CACHE.set_multi(dict((k, build()) for k, build in static.items() if k not in cached))
+
+    log.debug("Warming patterns.")
+    pids = list(config['patterns'].keys())
+    cached = info.CACHE.get_multi(pids, key_prefix="_pattern_")
+    patterns = {}
+    for pid in pids:
+        reckon.line(pid, config['patterns'])
+        if pid not in cached:
+            patterns[pid] = geojson.dumps(config['patterns'][pid])
+    info.CACHE.set_multi(patterns, key_prefix="_pattern_", min_compress_len=cacheutil.COMPRESS_OVER)
+
+    log.debug("Opening search index.")
+    utils.stopindex()
+
+def run(clock=time.time):
+    try:
+        warm()
+        STATE['ready'] = True
+    except Exception as e:
+        # Stay out of the load balancer until a retry succeeds
+        logging.getLogger(__name__).exception("Warm-up failed.")
+        STATE['error'] = str(e)
+    finally:
+        STATE['finished'] = clock()
+
+def start():
+    """Warm up in a background thread, unless a warm-up is already running."""
+    with _LOCK:
+        if STATE['started'] and not STATE['finished']:
+            return
+        STATE.update(started=time.time(), finished=None, error=None)
+    
+    t = threading.Thread(target=run, name="warmup")
+    t.daemon = True
+    t.start()
+    return t
+
+def retry():
+    """Start warm-up again if the last attempt failed `RETRY_AFTER` or more
+    seconds ago."""
+    if STATE['error'] and STATE['finished'] and time.time() - STATE['finished'] >= RETRY_AFTER:
+        start()
+
+@app.before_first_request
+def begin():
+    if app.config['warmup']:
+        start()
+
+def status():
+    resp = dict(STATE)
+    if STATE['started'] and STATE['finished']:
+        resp['seconds'] = round(STATE['finished'] - STATE['started'], 2)
+    return resp